@@ -0,0 +1,123 @@
+"""Filter and row-building loops for the unprocessed payments report
+
+Kept in its own fully annotated module so it can be compiled with mypyc
+(`mypyc _emit.py`); when the compiled extension is present the normal
+import picks it up, otherwise this source runs as-is.
+"""
+from typing import Any, Dict, FrozenSet, Iterator, List, Set, Tuple
+
+# Shared read-only stand-in for missing *Ref objects, avoiding a new {} per lookup
+_EMPTY: Dict[str, Any] = {}
+# (deposit ID, deposit DocNumber) for payments not included in any deposit
+_NO_DEPOSIT: Tuple[str, str] = ("", "")
+
+
+def select_payments(payments: List[Dict[str, Any]], valid_pm_ids: FrozenSet[str]) -> List[Dict[str, Any]]:
+    """Keep the unprocessed payments made by Credit Card or ACH
+
+    Args:
+        payments: Payment objects from the QBO query
+        valid_pm_ids: PaymentMethod IDs for Credit Card and ACH
+
+    Returns:
+        List of the payments that belong in the report
+    """
+    selected: List[Dict[str, Any]] = []
+
+    for payment in payments:
+        p_get = payment.get
+        # The date range is applied by the query; skip processed payments
+        # and anything not paid by CC or ACH
+        if p_get("ProcessPayment") is True:
+            continue
+
+        if (p_get("PaymentMethodRef") or _EMPTY).get("value") not in valid_pm_ids:
+            continue
+
+        selected.append(payment)
+
+    return selected
+
+
+def deposit_account_ids(payments: List[Dict[str, Any]]) -> Set[str]:
+    """Collect the DepositToAccountRef IDs referenced by the given payments
+
+    Args:
+        payments: Payments returned by select_payments
+
+    Returns:
+        Set of non-empty account IDs
+    """
+    account_ids: Set[str] = set()
+
+    for payment in payments:
+        account_id = (payment.get("DepositToAccountRef") or _EMPTY).get("value")
+        if account_id:
+            account_ids.add(account_id)
+
+    return account_ids
+
+
+def iter_rows(
+    payments: List[Dict[str, Any]],
+    pm_name_by_id: Dict[str, str],
+    accounts: Dict[str, str],
+    payment_to_deposit: Dict[str, Tuple[str, str]],
+) -> Iterator[Tuple[Any, ...]]:
+    """Yield a report row for every selected payment
+
+    Args:
+        payments: Payments returned by select_payments
+        pm_name_by_id: PaymentMethod ID -> name
+        accounts: Account ID -> name
+        payment_to_deposit: Payment ID -> (deposit ID, deposit DocNumber)
+
+    Yields:
+        Row tuples in FIELDNAMES order
+    """
+    accounts_get = accounts.get
+
+    for payment in payments:
+        p_get = payment.get
+        payment_method = pm_name_by_id[payment["PaymentMethodRef"]["value"]]
+
+        # Get deposit account ID and name
+        deposit_account_id = (p_get("DepositToAccountRef") or _EMPTY).get("value", "")
+        deposit_account_name = accounts_get(deposit_account_id, "")
+
+        # Get customer name
+        customer_ref = p_get("CustomerRef") or _EMPTY
+        customer_id = customer_ref.get("value", "")
+        customer_name = customer_ref.get("name", "")
+
+        # Get invoice number from the first Invoice linked in the payment lines
+        invoice_number = next((
+            linked_txn.get("TxnId", "")
+            for line in p_get("Line") or ()
+            for linked_txn in line.get("LinkedTxn") or ()
+            if linked_txn.get("TxnType") == "Invoice"
+        ), "")
+
+        # Check if payment has a matching deposit and get deposit info
+        payment_id = payment["Id"]
+        deposit_info = payment_to_deposit.get(payment_id)
+        has_matching_deposit = deposit_info is not None
+        deposit_id, deposit_number = deposit_info or _NO_DEPOSIT
+
+        yield (
+            payment_id,
+            payment["TxnDate"],
+            payment["TotalAmt"],
+            customer_id,
+            customer_name,
+            invoice_number,
+            payment_method,
+            p_get("PaymentRefNum"),
+            p_get("PrivateNote"),
+            deposit_account_id,
+            deposit_account_name,
+            has_matching_deposit,
+            deposit_id,
+            deposit_number,
+            True,
+        )
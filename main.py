@@ -1,14 +1,31 @@
+import asyncio
+import httpx
 import requests
-from typing import List, Dict
+from requests.adapters import HTTPAdapter
+from typing import Callable, List, Dict, Iterator, Optional, Set, Tuple
 from dotenv import load_dotenv
 import os
+import json
+import base64
+import time
+import tempfile
+import threading
+import functools
+import itertools
+from concurrent.futures import Future
 import csv
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+from email.message import EmailMessage
 from datetime import datetime, timedelta
+from nacl import encoding, public
+from _emit import deposit_account_ids, iter_rows, select_payments
+
+# orjson decodes QBO's large responses 2-3x faster; fall back to the stdlib if it isn't installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 load_dotenv()
 
@@ -24,117 +41,210 @@ to_email = os.getenv("TO_EMAIL")
 github_token = os.getenv("GH_PAT")
 github_repo = os.getenv("GH_REPO")
 
+QBO_PAGE_SIZE = 1000
+# Pin the QBO schema version; 75 is the baseline Intuit serves for older values
+QBO_MINOR_VERSION = "75"
+# Maximum QBO requests in flight at once, staying under Intuit's per-realm throttle
+QBO_MAX_CONNECTIONS = 8
+# Pages are ordered by the unique Id so pages fetched by separate, concurrent
+# requests never overlap or skip rows (TxnDate ties would be broken arbitrarily)
+QBO_PAGE_ORDER = "Id"
+# Account IDs per "Id IN (...)" lookup, keeping the query URL short
+ACCOUNT_ID_CHUNK_SIZE = 100
+
+TOKEN_CACHE_PATH = os.path.expanduser("~/.qbo_token.json")
+GH_PUBLIC_KEY_CACHE_PATH = os.path.expanduser("~/.gh_secret_key.json")
+# GitHub rotates repository public keys rarely; reuse a fetched key for a day
+GH_PUBLIC_KEY_MAX_AGE = 24 * 60 * 60
+
+FIELDNAMES = ["Payment_ID", "Date", "Total_Amount", "QBO_Customer_ID", "Customer_Name", "Invoice_Number", "Payment_Method", "Payment_Number", "Memo", "Deposit_Account_ID", "Deposit_Account_Name", "Has_Matching_Deposit", "Deposit_ID", "Deposit_Number", "Unprocessed"]
+
+# Shared keep-alive session so repeated calls reuse pooled connections. No retry
+# policy: it only carries the token refresh POST, and retrying that could spend
+# the single-use refresh token twice
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+# Separate session for the GitHub API so its public-key GET and secret PUT share a connection
+_GITHUB_SESSION = requests.Session()
+
+# In-flight token refresh shared by concurrent get_new_access_token callers
+_refresh_lock = threading.Lock()
+_refresh_future: Optional[Future] = None
+
 print(f"Client ID: {client_id[:10]}...")
 print(f"Refresh token: {refresh_token[:10]}...")
 print(f"Realm ID: {realm_id}")
 
-def update_github_secret(secret_name: str, secret_value: str, github_token: str, github_repo: str) -> bool:
+def _json(response: requests.Response):
+    """Decode a requests response body (with orjson when available)"""
+    return _json_loads(response.content)
+
+
+def _load_github_public_key(github_repo: str) -> Optional[Dict]:
+    """Return the cached Actions public key for github_repo, or None if missing or stale"""
+    try:
+        with open(GH_PUBLIC_KEY_CACHE_PATH, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("repo") == github_repo and time.time() - cached.get("fetched_at", 0) < GH_PUBLIC_KEY_MAX_AGE:
+        return cached
+    return None
+
+
+def _fetch_github_public_key(github_repo: str, headers: Dict) -> Dict:
+    """Fetch the repository's Actions public key and cache it on disk"""
+    key_url = f"https://api.github.com/repos/{github_repo}/actions/secrets/public-key"
+    key_response = _GITHUB_SESSION.get(key_url, headers=headers)
+    key_response.raise_for_status()
+    key_data = _json(key_response)
+
+    public_key = {
+        "repo": github_repo,
+        "key": key_data["key"],
+        "key_id": key_data["key_id"],
+        "fetched_at": time.time()
+    }
+    try:
+        with open(GH_PUBLIC_KEY_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(public_key, f)
+    except OSError as e:
+        print(f"⚠ Failed to cache GitHub public key: {str(e)}")
+    return public_key
+
+
+def _put_github_secret(secret_name: str, secret_value: str, public_key: Dict, github_repo: str, headers: Dict) -> requests.Response:
+    """Encrypt secret_value with the repository public key and PUT it"""
+    public_key_obj = public.PublicKey(public_key["key"].encode("utf-8"), encoding.Base64Encoder())
+    sealed_box = public.SealedBox(public_key_obj)
+    encrypted = sealed_box.encrypt(secret_value.encode("utf-8"))
+    encrypted_value = base64.b64encode(encrypted).decode("utf-8")
+
+    secret_url = f"https://api.github.com/repos/{github_repo}/actions/secrets/{secret_name}"
+    secret_data = {
+        "encrypted_value": encrypted_value,
+        "key_id": public_key["key_id"]
+    }
+    return _GITHUB_SESSION.put(secret_url, headers=headers, json=secret_data)
+
 
+def update_github_secret(secret_name: str, secret_value: str, github_token: str, github_repo: str) -> bool:
     """Update a GitHub repository secret
 
- 
+    The repository public key is cached for GH_PUBLIC_KEY_MAX_AGE; if GitHub
+    rejects a secret encrypted with a cached key, the key is refetched and
+    the update retried once.
 
     Args:
-
         secret_name: Name of the secret to update
-
         secret_value: New value for the secret
-
         github_token: GitHub Personal Access Token with repo scope
-
         github_repo: Repository in format "owner/repo"
 
- 
-
     Returns:
-
         bool: True if successful, False otherwise
-
     """
-
     try:
-
-        from nacl import encoding, public
-
-        import base64
-
- 
-
-        # Get repository public key
-
-        key_url = f"https://api.github.com/repos/{github_repo}/actions/secrets/public-key"
-
         headers = {
-
             "Authorization": f"Bearer {github_token}",
-
             "Accept": "application/vnd.github+json",
-
             "X-GitHub-Api-Version": "2022-11-28"
-
         }
 
- 
-
-        key_response = requests.get(key_url, headers=headers)
-
-        key_response.raise_for_status()
-
-        key_data = key_response.json()
-
- 
-
-        public_key = key_data["key"]
-
-        key_id = key_data["key_id"]
-
- 
-
-        # Encrypt the secret value
-
-        public_key_obj = public.PublicKey(public_key.encode("utf-8"), encoding.Base64Encoder())
-
-        sealed_box = public.SealedBox(public_key_obj)
-
-        encrypted = sealed_box.encrypt(secret_value.encode("utf-8"))
-
-        encrypted_value = base64.b64encode(encrypted).decode("utf-8")
-
- 
+        # Get repository public key, from cache when fresh
+        public_key = _load_github_public_key(github_repo)
+        from_cache = public_key is not None
+        if public_key is None:
+            public_key = _fetch_github_public_key(github_repo, headers)
 
         # Update the secret
+        secret_response = _put_github_secret(secret_name, secret_value, public_key, github_repo, headers)
+        if from_cache and secret_response.status_code in (404, 422):
+            # Cached key was rotated; refetch it and retry once
+            public_key = _fetch_github_public_key(github_repo, headers)
+            secret_response = _put_github_secret(secret_name, secret_value, public_key, github_repo, headers)
+        secret_response.raise_for_status()
 
-        secret_url = f"https://api.github.com/repos/{github_repo}/actions/secrets/{secret_name}"
-
-        secret_data = {
+        print(f"✓ Successfully updated GitHub secret '{secret_name}'")
+        return True
+    except Exception as e:
+        print(f"✗ Failed to update GitHub secret '{secret_name}': {str(e)}")
+        return False
 
-            "encrypted_value": encrypted_value,
 
-            "key_id": key_id
+def load_cached_access_token() -> Optional[str]:
+    """Return the cached QuickBooks access token, or None if missing or expired"""
+    try:
+        with open(TOKEN_CACHE_PATH, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
 
-        }
+    if cached.get("expires_at", 0) > time.time():
+        return cached.get("access_token")
+    return None
 
- 
 
-        secret_response = requests.put(secret_url, headers=headers, json=secret_data)
+def save_cached_access_token(access_token: str, expires_in: int):
+    """Cache an access token on disk (mode 0600) until a minute before it expires
 
-        secret_response.raise_for_status()
+    The file is written to a temporary name and swapped in with os.replace,
+    so readers never see a partially written cache.
+    """
+    try:
+        # mkstemp creates the file with mode 0600
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(TOKEN_CACHE_PATH), prefix=".qbo_token.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"access_token": access_token, "expires_at": time.time() + expires_in - 60}, f)
+            os.replace(tmp_path, TOKEN_CACHE_PATH)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError as e:
+        print(f"⚠ Failed to cache access token: {str(e)}")
+
+
+def invalidate_cached_access_token():
+    """Remove the cached access token so the next run refreshes it"""
+    try:
+        os.remove(TOKEN_CACHE_PATH)
+    except FileNotFoundError:
+        pass
 
- 
 
-        print(f"✓ Successfully updated GitHub secret '{secret_name}'")
+def get_new_access_token(client_id: str, client_secret: str, refresh_token: str) -> str:
+    """Refresh QuickBooks access token using refresh token
 
-        return True
+    Concurrent callers share a single in-flight refresh, so the refresh
+    token is only spent (and the GitHub secret only rotated) once.
+    """
+    global _refresh_future
 
-    except Exception as e:
+    with _refresh_lock:
+        future = _refresh_future
+        is_owner = future is None
+        if is_owner:
+            future = _refresh_future = Future()
 
-        print(f"✗ Failed to update GitHub secret '{secret_name}': {str(e)}")
+    if not is_owner:
+        return future.result()
 
-        return False
+    try:
+        access_token = _refresh_access_token(client_id, client_secret, refresh_token)
+        future.set_result(access_token)
+        return access_token
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _refresh_lock:
+            _refresh_future = None
 
 
-def get_new_access_token(client_id: str, client_secret: str, refresh_token: str) -> str:
-    """Refresh QuickBooks access token using refresh token"""
+def _refresh_access_token(client_id: str, client_secret: str, refresh_token: str) -> str:
+    """Call the Intuit token endpoint and persist the rotated tokens"""
     try:
         token_url = "https://oauth.platform.intuit.com/oauth2/v1/tokens/bearer"
 
@@ -152,13 +262,15 @@ def get_new_access_token(client_id: str, client_secret: str, refresh_token: str)
         from requests.auth import HTTPBasicAuth
         auth = HTTPBasicAuth(client_id, client_secret)
 
-        response = requests.post(token_url, headers=headers, data=data, auth=auth)
+        response = _SESSION.post(token_url, headers=headers, data=data, auth=auth)
         response.raise_for_status()
 
-        token_data = response.json()
+        token_data = _json(response)
         new_access_token = token_data.get("access_token")
         new_refresh_token = token_data.get("refresh_token")
 
+        save_cached_access_token(new_access_token, token_data.get("expires_in", 3600))
+
         if github_token and github_repo and new_refresh_token:
 
             update_github_secret("REFRESH_TOKEN", new_refresh_token, github_token, github_repo)
@@ -178,173 +290,211 @@ def get_new_access_token(client_id: str, client_secret: str, refresh_token: str)
         raise
 
 
-def get_qbo_credits(access_token: str, realm_id: str) -> List[Dict]:
-    """Get unprocessed QBO payments with Credit Card or ACH payment method"""
+def count_query(entity: str, where: str = "") -> str:
+    """Build a COUNT query for a QBO entity, optionally filtered by a WHERE clause"""
+    where_clause = f" WHERE {where}" if where else ""
+    return f"SELECT COUNT(*) FROM {entity}{where_clause}"
+
+
+def page_query(entity: str, start_position: int, where: str = "") -> str:
+    """Build the query for one page of a QBO entity, optionally filtered by a WHERE clause"""
+    where_clause = f" WHERE {where}" if where else ""
+    return f"SELECT * FROM {entity}{where_clause} ORDERBY {QBO_PAGE_ORDER} STARTPOSITION {start_position} MAXRESULTS {QBO_PAGE_SIZE}"
+
+
+async def qbo_query(client: httpx.AsyncClient, slots: asyncio.Semaphore, query_url: str, query: str) -> Dict:
+    """Run a QBO query and return its QueryResponse, holding one of slots while it is in flight"""
+    async with slots:
+        response = await client.get(query_url, params={"query": query, "minorversion": QBO_MINOR_VERSION})
+    response.raise_for_status()
+    data = _json_loads(response.content)
+    return data["QueryResponse"]
+
+
+async def qbo_batch(client: httpx.AsyncClient, slots: asyncio.Semaphore, batch_url: str, queries: Dict[str, str]) -> Dict[str, Dict]:
+    """Run several QBO queries in a single batch request
+
+    Args:
+        slots: Semaphore capping requests in flight, held while the batch runs
+        queries: Mapping of batch item ID to query
+
+    Returns:
+        Dict mapping each batch item ID to its QueryResponse
+    """
+    payload = {
+        "BatchItemRequest": [{"bId": bid, "Query": query} for bid, query in queries.items()]
+    }
+    async with slots:
+        response = await client.post(batch_url, params={"minorversion": QBO_MINOR_VERSION}, json=payload)
+    response.raise_for_status()
+    data = _json_loads(response.content)
+
+    results = {}
+    for item in data.get("BatchItemResponse", []):
+        if "Fault" in item:
+            raise RuntimeError(f"QBO batch query '{item.get('bId')}' failed: {item['Fault']}")
+        results[item["bId"]] = item.get("QueryResponse", {})
+    return results
+
+
+async def fetch_page(client: httpx.AsyncClient, slots: asyncio.Semaphore, query_url: str, entity: str, start_position: int, where: str = "", select: Optional[Callable[[List[Dict]], List[Dict]]] = None) -> List[Dict]:
+    """Fetch one page of a QBO entity starting at start_position
+
+    If given, select is applied to the page as soon as it arrives so only
+    the rows it keeps stay in memory.
+    """
+    query_response = await qbo_query(client, slots, query_url, page_query(entity, start_position, where))
+    rows = query_response.get(entity, [])
+    return select(rows) if select else rows
+
+
+async def fetch_all(client: httpx.AsyncClient, slots: asyncio.Semaphore, query_url: str, entity: str, where: str = "", first_page: Optional[List[Dict]] = None, total_count: Optional[int] = None, select: Optional[Callable[[List[Dict]], List[Dict]]] = None) -> List[Dict]:
+    """Fetch every row of a QBO entity, requesting pages concurrently
+
+    The entity's row count (from a COUNT query unless already known)
+    determines how many pages there are, and every page not already
+    retrieved (e.g. through a batch request) is requested in one gather.
+    If given, select filters each page as it arrives.
+    """
+    if total_count is None:
+        count_response = await qbo_query(client, slots, query_url, count_query(entity, where))
+        total_count = count_response.get("totalCount", 0)
+
+    rows = []
+    if first_page is not None:
+        rows.extend(select(first_page) if select else first_page)
+    first_start = 1 if first_page is None else 1 + QBO_PAGE_SIZE
+    pages = await asyncio.gather(*[
+        fetch_page(client, slots, query_url, entity, start_position, where, select)
+        for start_position in range(first_start, total_count + 1, QBO_PAGE_SIZE)
+    ])
+    for page in pages:
+        rows.extend(page)
+    return rows
+
+
+async def fetch_account_names(client: httpx.AsyncClient, slots: asyncio.Semaphore, query_url: str, account_ids: Set[str]) -> Dict[str, str]:
+    """Look up the names of the given accounts, ACCOUNT_ID_CHUNK_SIZE IDs per query"""
+    ids = sorted(account_ids)
+    chunks = [ids[i:i + ACCOUNT_ID_CHUNK_SIZE] for i in range(0, len(ids), ACCOUNT_ID_CHUNK_SIZE)]
+    pages = await asyncio.gather(*[
+        fetch_page(client, slots, query_url, "Account", 1, "Id IN ({})".format(", ".join(f"'{account_id}'" for account_id in chunk)))
+        for chunk in chunks
+    ])
+    return {
+        account["Id"]: account.get("Name", account.get("FullyQualifiedName", ""))
+        for page in pages
+        for account in page
+    }
+
+
+async def iter_qbo_credits(access_token: str, realm_id: str) -> Iterator[Tuple]:
+    """Get unprocessed QBO payments with Credit Card or ACH payment method
+
+    All QBO queries finish before this returns; the report rows (tuples in
+    FIELDNAMES order) are then built lazily as the returned iterator is
+    consumed.
+    """
     
-    base_url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/query"
+    base_url = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}"
+    query_url = f"{base_url}/query"
+    batch_url = f"{base_url}/batch"
     headers = {
         "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json"
-    }
-    
-    # Get payment methods
-    pm_response = requests.get(
-        base_url,
-        params={"query": "SELECT * FROM PaymentMethod"},
-        headers=headers
-    )
-    payment_methods = {
-        pm["Id"]: pm["Name"] 
-        for pm in pm_response.json()["QueryResponse"].get("PaymentMethod", [])
+        "Accept": "application/json",
+        # QBO JSON compresses ~10x; httpx decompresses transparently
+        "Accept-Encoding": "gzip, deflate"
     }
     
-    # Get all accounts with pagination
-    accounts = {}
-    start_position = 1
-    max_results = 1000
+    # Calculate date one month ago; only payments from then on, and the
+    # deposits that could contain them, are requested
+    cutoff = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    txn_date_filter = f"TxnDate >= '{cutoff}'"
     
-    while True:
-        query = f"SELECT * FROM Account STARTPOSITION {start_position} MAXRESULTS {max_results}"
-        response = requests.get(base_url, params={"query": query}, headers=headers)
-        account_list = response.json()["QueryResponse"].get("Account", [])
+    # HTTP/2 multiplexes the concurrent requests over a single TLS connection, so the
+    # connection limit does not bound them; slots caps requests in flight. Both are
+    # created here because they bind to the running event loop
+    limits = httpx.Limits(max_connections=QBO_MAX_CONNECTIONS)
+    slots = asyncio.Semaphore(QBO_MAX_CONNECTIONS)
+    async with httpx.AsyncClient(http2=True, timeout=30, headers=headers, limits=limits) as client:
+        # Get the first page and row count of every entity in one batch request
+        first_pages = await qbo_batch(client, slots, batch_url, {
+            "PaymentMethod": "SELECT * FROM PaymentMethod",
+            "Deposit": page_query("Deposit", 1, txn_date_filter),
+            "DepositCount": count_query("Deposit", txn_date_filter),
+            "Payment": page_query("Payment", 1, txn_date_filter),
+            "PaymentCount": count_query("Payment", txn_date_filter),
+        })
         
-        for account in account_list:
-            accounts[account["Id"]] = account.get("Name", account.get("FullyQualifiedName", ""))
+        payment_methods = {
+            pm["Id"]: pm["Name"] 
+            for pm in first_pages["PaymentMethod"].get("PaymentMethod", [])
+        }
+        # Resolve the Credit Card / ACH payment method IDs once
+        valid_pm_ids = frozenset(
+            pm_id for pm_id, name in payment_methods.items() if name in ("Credit Card", "ACH")
+        )
         
-        if len(account_list) < max_results:
-            break
-        start_position += max_results
-    
-    # Get all deposits with pagination and extract payment IDs from them
-    # Map payment_id -> deposit info (ID and DocNumber)
-    payment_to_deposit = {}
-    start_position = 1
-    max_results = 1000
-    
-    while True:
-        query = f"SELECT * FROM Deposit STARTPOSITION {start_position} MAXRESULTS {max_results}"
-        response = requests.get(base_url, params={"query": query}, headers=headers)
-        deposits = response.json()["QueryResponse"].get("Deposit", [])
+        # Quiet period (or no CC/ACH methods): skip the Deposit and Account work entirely
+        if not valid_pm_ids or not first_pages["PaymentCount"].get("totalCount", 0):
+            return iter(())
         
-        # Extract payment IDs from deposit lines and map to deposit info
-        for deposit in deposits:
-            deposit_id = deposit.get("Id", "")
-            deposit_number = deposit.get("DocNumber", "")
-            deposit_lines = deposit.get("Line", [])
-            for line in deposit_lines:
-                linked_txns = line.get("LinkedTxn", [])
-                if linked_txns:
-                    for linked_txn in linked_txns:
-                        if linked_txn.get("TxnType") == "Payment":
-                            payment_id = linked_txn.get("TxnId", "")
-                            if payment_id:
-                                # Store deposit ID and number for this payment
-                                payment_to_deposit[payment_id] = {
-                                    "Deposit_ID": deposit_id,
-                                    "Deposit_Number": deposit_number
-                                }
+        async def fetch_report_payments():
+            # Filter each Payment page on arrival instead of buffering every payment
+            payments = await fetch_all(client, slots, query_url, "Payment", txn_date_filter,
+                                       first_page=first_pages["Payment"].get("Payment", []),
+                                       total_count=first_pages["PaymentCount"].get("totalCount", 0),
+                                       select=functools.partial(select_payments, valid_pm_ids=valid_pm_ids))
+            
+            # Only look up the deposit accounts the report references
+            accounts = await fetch_account_names(client, slots, query_url, deposit_account_ids(payments))
+            return payments, accounts
         
-        if len(deposits) < max_results:
-            break
-        start_position += max_results
-    
-    # Get all payments with pagination
-    all_payments = []
-    start_position = 1
-    max_results = 1000
+        # Fetch all remaining pages at once; most companies have none
+        deposits, (payments, accounts) = await asyncio.gather(
+            fetch_all(client, slots, query_url, "Deposit", txn_date_filter,
+                      first_page=first_pages["Deposit"].get("Deposit", []),
+                      total_count=first_pages["DepositCount"].get("totalCount", 0)),
+            fetch_report_payments(),
+        )
     
-    while True:
-        query = f"SELECT * FROM Payment STARTPOSITION {start_position} MAXRESULTS {max_results}"
-        response = requests.get(base_url, params={"query": query}, headers=headers)
-        payments = response.json()["QueryResponse"].get("Payment", [])
-        all_payments.extend(payments)
-        
-        if len(payments) < max_results:
-            break
-        start_position += max_results
+    # Extract payment IDs from deposit lines
+    # Map payment_id -> (deposit ID, deposit DocNumber)
+    payment_to_deposit = {
+        linked_txn["TxnId"]: (deposit.get("Id", ""), deposit.get("DocNumber", ""))
+        for deposit in deposits
+        for line in deposit.get("Line") or ()
+        for linked_txn in line.get("LinkedTxn") or ()
+        if linked_txn.get("TxnType") == "Payment" and linked_txn.get("TxnId")
+    }
     
-    # Filter and format
-    credit_list = []
-    # Calculate date one month ago
-    one_month_ago = (datetime.now() - timedelta(days=30)).date()
+    return iter_rows(payments, payment_methods, accounts, payment_to_deposit)
 
-    for payment in all_payments:
-        # Check if unprocessed and payment method is CC or ACH
-        is_unprocessed = payment.get("ProcessPayment") != True
 
-        payment_method_id = payment.get("PaymentMethodRef", {}).get("value")
-        payment_method = payment_methods.get(payment_method_id, "")
-        is_valid_method = payment_method in ["Credit Card", "ACH"]
+def send_emails(messages: List[EmailMessage]):
+    """Send messages over one SMTP connection, logging in only once
 
-        # Check if payment is within the last month
-        payment_date_str = payment.get("TxnDate", "")
-        try:
-            payment_date = datetime.strptime(payment_date_str, "%Y-%m-%d").date()
-            is_recent = payment_date >= one_month_ago
-        except (ValueError, AttributeError):
-            is_recent = False
-
-        # Get deposit account ID and name
-        deposit_account_ref = payment.get("DepositToAccountRef", {})
-        deposit_account_id = deposit_account_ref.get("value", "")
-        deposit_account_name = accounts.get(deposit_account_id, "")
-
-        # Only include if unprocessed, valid payment method, and within last month
-        if is_unprocessed and is_valid_method and is_recent:
-            # Get customer name
-            customer_ref = payment.get("CustomerRef", {})
-            customer_id = customer_ref.get("value", "")
-            customer_name = customer_ref.get("name", "")
-            
-            # Get invoice number from payment lines
-            invoice_number = ""
-            payment_lines = payment.get("Line", [])
-            if payment_lines:
-                # Look for LinkedTxn in the lines to find invoice references
-                for line in payment_lines:
-                    linked_txns = line.get("LinkedTxn", [])
-                    if linked_txns:
-                        # Get the invoice number directly from linked transactions
-                        for linked_txn in linked_txns:
-                            if linked_txn.get("TxnType") == "Invoice":
-                                invoice_number = linked_txn.get("TxnId", "")
-                                break
-                        if invoice_number:
-                            break
-            
-            # Check if payment has a matching deposit and get deposit info
-            payment_id = payment["Id"]
-            deposit_info = payment_to_deposit.get(payment_id, {})
-            has_matching_deposit = payment_id in payment_to_deposit
-            deposit_id = deposit_info.get("Deposit_ID", "")
-            deposit_number = deposit_info.get("Deposit_Number", "")
-            
-            credit_list.append({
-                "Payment_ID": payment["Id"],
-                "Date": payment["TxnDate"],
-                "Total_Amount": payment["TotalAmt"],
-                "QBO_Customer_ID": customer_id,
-                "Customer_Name": customer_name,
-                "Invoice_Number": invoice_number,
-                "Payment_Method": payment_method,
-                "Payment_Number": payment.get("PaymentRefNum"),
-                "Memo": payment.get("PrivateNote"),
-                "Deposit_Account_ID": deposit_account_id,
-                "Deposit_Account_Name": deposit_account_name,
-                "Has_Matching_Deposit": has_matching_deposit,
-                "Deposit_ID": deposit_id,
-                "Deposit_Number": deposit_number,
-                "Unprocessed": is_unprocessed,
-            })
-    
-    return credit_list
+    Port 465 uses implicit TLS (SMTP_SSL), saving the STARTTLS round trip;
+    any other port upgrades the connection with STARTTLS.
+    """
+    if smtp_port == 465:
+        server = smtplib.SMTP_SSL(smtp_host, smtp_port)
+    else:
+        server = smtplib.SMTP(smtp_host, smtp_port)
+
+    with server:
+        if smtp_port != 465:
+            server.starttls()
+        server.login(smtp_user, smtp_pass)
+        for msg in messages:
+            server.send_message(msg)
 
 
 def send_email_with_csv(csv_filename: str, record_count: int):
     """Send email with CSV attachment"""
     try:
         # Create message
-        msg = MIMEMultipart()
+        msg = EmailMessage()
         msg['From'] = smtp_user
         msg['To'] = to_email
         msg['Subject'] = f'Unprocessed Payments Report - {datetime.now().strftime("%B %d, %Y")}'
@@ -364,27 +514,14 @@ This report includes:
 Best regards,
 Automated Payment Report System
 """
-        msg.attach(MIMEText(body, 'plain'))
+        msg.set_content(body)
 
         # Attach CSV file
         with open(csv_filename, 'rb') as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-
-        encoders.encode_base64(part)
-        part.add_header(
-            'Content-Disposition',
-            f'attachment; filename= {csv_filename}'
-        )
-        msg.attach(part)
+            msg.add_attachment(attachment.read(), maintype='text', subtype='csv', filename=csv_filename)
 
         # Send email
-        server = smtplib.SMTP(smtp_host, smtp_port)
-        server.starttls()
-        server.login(smtp_user, smtp_pass)
-        text = msg.as_string()
-        server.sendmail(smtp_user, to_email, text)
-        server.quit()
+        send_emails([msg])
 
         print(f"Email sent successfully to {to_email}")
         return True
@@ -393,25 +530,56 @@ Automated Payment Report System
         return False
 
 
-if __name__ == "__main__":
-    # Get fresh access token
-    access_token = get_new_access_token(client_id, client_secret, refresh_token)
+async def main():
+    # Reuse the cached access token while it is valid, otherwise get a fresh one
+    access_token = load_cached_access_token()
+    token_from_cache = bool(access_token)
+    if token_from_cache:
+        print("Using cached access token")
+    else:
+        access_token = get_new_access_token(client_id, client_secret, refresh_token)
 
-    credit_list = get_qbo_credits(access_token, realm_id)
+    try:
+        credit_rows = await iter_qbo_credits(access_token, realm_id)
+    except httpx.HTTPStatusError as e:
+        # A freshly minted token being rejected isn't a stale-token problem, and
+        # refreshing again would spend another single-use refresh token
+        if e.response.status_code != 401 or not token_from_cache:
+            raise
+        # Cached token was rejected: drop the cache, refresh and try once more
+        print("Access token rejected - refreshing")
+        invalidate_cached_access_token()
+        access_token = get_new_access_token(client_id, client_secret, refresh_token)
+        credit_rows = await iter_qbo_credits(access_token, realm_id)
+
+    # Skip the CSV entirely when there is nothing to report
+    first_row = next(credit_rows, None)
+    if first_row is None:
+        print("No unprocessed payments found matching the criteria (valid payment method, unprocessed, last 30 days).")
+        return
+
+    # Stream report rows straight into the CSV file
+    csv_filename = "unprocessed_payments.csv"
+    record_count = 0
+    credit_rows = itertools.chain((first_row,), credit_rows)
+    try:
+        # A 1 MiB buffer keeps large reports to a handful of write() calls
+        with open(csv_filename, "w", newline="", encoding="utf-8", buffering=1 << 20) as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(FIELDNAMES)
+            for record_count, row in enumerate(credit_rows, 1):
+                writer.writerow(row)
+    except BaseException:
+        # Don't leave a partial report behind for the artifact upload
+        if os.path.exists(csv_filename):
+            os.remove(csv_filename)
+        raise
 
-    # Write to CSV file
-    if credit_list:
-        csv_filename = "unprocessed_payments.csv"
-        fieldnames = ["Payment_ID", "Date", "Total_Amount", "QBO_Customer_ID", "Customer_Name", "Invoice_Number", "Payment_Method", "Payment_Number", "Memo", "Deposit_Account_ID", "Deposit_Account_Name", "Has_Matching_Deposit", "Deposit_ID", "Deposit_Number", "Unprocessed"]
+    print(f"Successfully wrote {record_count} records to {csv_filename}")
 
-        with open(csv_filename, "w", newline="", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(credit_list)
+    # Send email with CSV attachment
+    send_email_with_csv(csv_filename, record_count)
 
-        print(f"Successfully wrote {len(credit_list)} records to {csv_filename}")
 
-        # Send email with CSV attachment
-        send_email_with_csv(csv_filename, len(credit_list))
-    else:
-        print("No unprocessed payments found matching the criteria (valid payment method, unprocessed, last 30 days).")
+if __name__ == "__main__":
+    asyncio.run(main())